@@ -1,10 +1,14 @@
+import asyncio
+import logging
 import os
+import threading
 
 from dotenv import load_dotenv
 from fastapi import HTTPException
-import validators
+from fastapi.concurrency import run_in_threadpool
 
 from app.caddy.caddy_config import CaddyAPIConfigurator
+from app.utils import is_valid_domain
 
 HTTPS_PORT = 443
 
@@ -12,8 +16,12 @@ DEFAULT_ADMIN_URL = 'http://localhost:2019'
 DEFAULT_CADDY_FILE = "domains/caddy.json"
 DEFAULT_SAAS_UPSTREAM = "example.com:443"
 DEFAULT_LOCAL_PORT = f"{HTTPS_PORT}"
+CONFIG_SAVE_INTERVAL = 0.25
+# Longest wait between retries while Caddy keeps failing to return its config
+CONFIG_SAVE_MAX_BACKOFF = 60
 
 load_dotenv()
+logger = logging.getLogger(__name__)
 
 
 class Caddy:
@@ -25,6 +33,15 @@ class Caddy:
         self.local_port = os.environ.get('LOCAL_PORT', DEFAULT_LOCAL_PORT)
         self.disable_https = os.environ.get('DISABLE_HTTPS', 'False').upper() == "TRUE"
 
+        # Domains as deployed on Caddy, rebuilt lazily after each config change
+        self._domains = None
+        self._dirty = False
+        # Set once the background saver is running, wakes it up when the config changes
+        self._loop = None
+        self._dirty_event = None
+        # Handlers call into Caddy from the threadpool, config changes must not interleave
+        self._lock = threading.Lock()
+
         self.configurator = CaddyAPIConfigurator(
             api_url=self.admin_url,
             https_port=self.local_port,
@@ -39,29 +56,84 @@ class Caddy:
         
 
     def add_custom_domain(self, domain, upstream):
-        if not validators.domain(domain):
+        if not is_valid_domain(domain):
             raise HTTPException(status_code=400, detail=f"{domain} is not a valid domain")
 
         upstream = upstream or self.saas_upstream
-        if not self.configurator.add_domain(domain, upstream):
-            raise HTTPException(status_code=400, detail=f"Failed to add domain: {domain}")
-
-        self.configurator.save_config(self.config_json_file)
+        with self._lock:
+            if not self.configurator.add_domain(domain, upstream):
+                raise HTTPException(status_code=400, detail=f"Failed to add domain: {domain}")
+            self._domains = None
+            self._mark_dirty()
 
     def remove_custom_domain(self, domain):
-        if not validators.domain(domain):
+        if not is_valid_domain(domain):
             raise HTTPException(status_code=400, detail=f"{domain} is not a valid domain")
 
-        if not self.configurator.delete_domain(domain):
-            raise HTTPException(status_code=400, detail=f"Failed to remove domain: {domain}. Might not be exist.")
-
-        self.configurator.save_config(self.config_json_file)
+        with self._lock:
+            if not self.configurator.delete_domain(domain):
+                raise HTTPException(status_code=400, detail=f"Failed to remove domain: {domain}. Might not be exist.")
+            self._domains = None
+            self._mark_dirty()
+
+    def save_config(self):
+        with self._lock:
+            if not self._dirty:
+                return True
+            # Only clear the flag once the config is on disk, a failed save stays pending
+            if self.configurator.save_config(self.config_json_file):
+                self._dirty = False
+                return True
+            return False
+
+    def _mark_dirty(self):
+        self._dirty = True
+        if self._loop is not None:
+            self._loop.call_soon_threadsafe(self._dirty_event.set)
+
+    async def save_config_in_background(self, interval=CONFIG_SAVE_INTERVAL):
+        self._dirty_event = asyncio.Event()
+        if self._dirty:
+            self._dirty_event.set()
+        self._loop = asyncio.get_running_loop()
+        failures = 0
+        while True:
+            await self._dirty_event.wait()
+            # Changes made within one interval are written to disk with a single save
+            await asyncio.sleep(interval)
+            self._dirty_event.clear()
+            try:
+                saved = await run_in_threadpool(self.save_config)
+            except Exception as e:
+                logger.error("An error occurred while saving the configuration: %s", e)
+                saved = False
+            if saved:
+                failures = 0
+                continue
+            # Keep the changes pending and back off before retrying
+            failures += 1
+            self._dirty = True
+            await asyncio.sleep(min(interval * 2 ** failures, CONFIG_SAVE_MAX_BACKOFF))
+            self._dirty_event.set()
+
+    def close(self):
+        self.configurator.close()
 
     def deployed_config(self):
         return self.configurator.config
 
     def list_domains(self):
-        return self.configurator.list_domains()
+        # The cached tuple is immutable and replaced as a whole, so reading it needs no lock
+        domains = self._domains
+        if domains is not None:
+            return list(domains)
+        with self._lock:
+            if self._domains is None:
+                domains = self.configurator.list_domains()
+                if domains is None:
+                    return None
+                self._domains = tuple(domains)
+            return list(self._domains)
 
 
 caddy_server = Caddy()
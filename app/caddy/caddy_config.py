@@ -1,7 +1,11 @@
+import functools
 import logging
 import os
+from enum import Enum
+
+import orjson
 import requests
-import json
+from requests.adapters import HTTPAdapter
 from http import HTTPStatus
 from fastapi import HTTPException
 from app.caddy import saas_template
@@ -34,16 +38,41 @@ new_route = {
 DEFAULT_CADDY_FILE = "domains/caddy.json"
 
 
+class LoadResult(Enum):
+    LOADED = "loaded"
+    # Caddy refused the config with a 4xx, its running config is unchanged
+    REJECTED = "rejected"
+    # Caddy failed with a 5xx, the running config is unknown
+    FAILED = "failed"
+
+    def __bool__(self):
+        return self is LoadResult.LOADED
+
+
 class CaddyAPIConfigurator:
 
     def __init__(self, api_url, https_port, disable_https=False):
         self.logger = logging.getLogger(__name__)
         self.api_url = api_url
         self.config = {}
+        # Serialized copy of the last config Caddy accepted, decoded whenever an isolated copy is needed
+        self._config_bytes = orjson.dumps(self.config)
         self.https_port = https_port
         self.disable_https = disable_https
         self.config_json_file = os.environ.get("CADDY_CONFIG_FILE", DEFAULT_CADDY_FILE)
 
+        # Port and HTTPS mode are fixed for the lifetime of the configurator
+        self._add_https_domain = functools.partial(
+            saas_template.add_https_domain,
+            port=self.https_port,
+            disable_https=self.disable_https,
+        )
+
+        # Keep connections to the admin API alive between calls
+        self._session = requests.Session()
+        self._session.mount("http://", HTTPAdapter(pool_connections=4, pool_maxsize=16))
+        self._session.headers.update({"Content-Type": "application/json"})
+
     def init_config(self):
         config = saas_template.https_template(disable_https=self.disable_https)
         if self.load_new_config(config):
@@ -88,101 +117,158 @@ class CaddyAPIConfigurator:
             "disable"
         ] = self.disable_https
 
-    def load_new_config(self, config):
+    def load_new_config(self, config, *, body=None):
         try:
             # Update the Caddy configuration using the /load endpoint
-            headers = {"Content-Type": "application/json"}
-            response = requests.post(
-                f"{self.api_url}/load", headers=headers, data=json.dumps(config)
-            )
+            if body is None:
+                body = orjson.dumps(config)
+            response = self._session.post(f"{self.api_url}/load", data=body)
             response.raise_for_status()
 
-            self.logger.info(f"Configuration has been loaded from config:\n{config}")
+            self.logger.info("Configuration has been loaded (%d bytes)", len(body))
             self.config = config
-            return True
+            self._config_bytes = body
+            return LoadResult.LOADED
         except requests.exceptions.HTTPError as e:
-            self.logger.error(f"An error occurred while loading the configuration: {e}")
-            self.logger.error(f"Response content: {response.content.decode('utf-8')}")
-            return False
+            self.logger.error("An error occurred while loading the configuration: %s", e)
+            self.logger.error("Response content: %s", response.content.decode('utf-8'))
+            if response.status_code < 500:
+                return LoadResult.REJECTED
+            return LoadResult.FAILED
+
+    def load_or_rollback(self, new_config):
+        if new_config == self.config:
+            return True
+
+        # A rejected config was never applied, only restore the previous one when the outcome is unknown
+        result = self.load_new_config(new_config)
+        if result is LoadResult.FAILED:
+            self.load_new_config(self.config, body=self._config_bytes)
+        return bool(result)
 
     def load_config_from_file(self, file_path):
         try:
-            with open(file_path, "r") as config_file:
-                config = json.load(config_file)
+            with open(file_path, "rb") as config_file:
+                config = orjson.loads(config_file.read())
                 success = self.load_new_config(config)
                 if success:
                     self.config = config
-                return success
+                return bool(success)
         except FileNotFoundError as e:
-            self.logger.error(f"An error occurred while loading the configuration: {e}")
+            self.logger.error("An error occurred while loading the configuration: %s", e)
             return False
 
     def save_config(self, file_path):
         try:
             # Fetch the entire Caddy configuration
-            response = requests.get(f"{self.api_url}/config/")
+            response = self._session.get(f"{self.api_url}/config/")
             response.raise_for_status()
-            config = response.json()
+            config = orjson.loads(response.content)
+
+            # Write to a temporary file first so a crash never leaves a truncated config
+            tmp_path = f"{file_path}.tmp"
+            with open(tmp_path, "wb") as config_file:
+                config_file.write(orjson.dumps(config, option=orjson.OPT_INDENT_2))
+                # Make sure the data is on disk before the rename makes it visible
+                config_file.flush()
+                os.fsync(config_file.fileno())
+            os.replace(tmp_path, file_path)
+
+            self.logger.info("Configuration has been saved to %s.", file_path)
+            return True
 
-            # Save the configuration to a file
-            with open(file_path, "w") as config_file:
-                json.dump(config, config_file, indent=2)
+        except requests.exceptions.HTTPError as e:
+            self.logger.error("An error occurred while saving the configuration: %s", e)
+            self.logger.error("Response content: %s", response.content.decode('utf-8'))
+            return False
 
-            self.logger.info(f"Configuration has been saved to {file_path}.")
+    def apply_route_change(self, method, path, new_config, route=None):
+        # Scoped admin API changes are applied atomically, a rejected change leaves Caddy untouched
+        try:
+            response = self._session.request(
+                method,
+                f"{self.api_url}{path}",
+                data=orjson.dumps(route) if route is not None else None,
+            )
+            response.raise_for_status()
 
+            self.config = new_config
+            self._config_bytes = orjson.dumps(new_config)
+            return True
         except requests.exceptions.HTTPError as e:
-            self.logger.error(f"An error occurred while saving the configuration: {e}")
-            self.logger.error(f"Response content: {response.content.decode('utf-8')}")
-            return
+            self.logger.error("An error occurred while updating the configuration: %s", e)
+            self.logger.error("Response content: %s", response.content.decode('utf-8'))
+            return False
 
     def add_domain(self, domain, upstream):
         try:
-            config = self.config.copy()
+            config = orjson.loads(self._config_bytes)
+            routes = self._routes(config)
+            exists = domain in saas_template.list_domains(config, port=self.https_port)
 
             try:
-                new_config = saas_template.add_https_domain(
-                    domain,
-                    upstream,
-                    template=config,
-                    port=self.https_port,
-                    disable_https=self.disable_https,
-                )
+                new_config = self._add_https_domain(domain, upstream, template=config)
 
-                # Try loading new config. If not successful, load the previous config
-                if self.load_new_config(new_config):
-                    return True
+                # A new domain only appends one route, so just send that route
+                if routes is not None and not exists:
+                    return self.apply_route_change(
+                        "POST",
+                        f"/config/apps/http/servers/{self.https_port}/routes",
+                        new_config,
+                        route=self._routes(new_config)[-1],
+                    )
 
-                self.load_new_config(config)
-                return False
+                # Try loading new config. If not successful, restore the previous config
+                return self.load_or_rollback(new_config)
 
             except DomainAlreadyExists as dae:
-                self.logger.error(f"Domain '{domain} already exists somewhere else.")
+                self.logger.error("Domain '%s already exists somewhere else.", domain)
                 raise
 
         except requests.exceptions.HTTPError as e:
             self.logger.error(
-                f"An error occurred while adding the domain '{domain}': {e}"
+                "An error occurred while adding the domain '%s': %s", domain, e
             )
             raise
 
+    def add_domains(self, domains):
+        # Apply every (domain, upstream) pair to one config and load it with a single request
+        try:
+            new_config = orjson.loads(self._config_bytes)
+            for domain, upstream in domains:
+                new_config = self._add_https_domain(domain, upstream, template=new_config)
+
+            # Try loading new config. If not successful, restore the previous config
+            return self.load_or_rollback(new_config)
+
+        except requests.exceptions.HTTPError as e:
+            self.logger.error("An error occurred while adding domains: %s", e)
+            raise
+
     def delete_domain(self, domain):
         try:
-            config = self.config.copy()
+            config = orjson.loads(self._config_bytes)
+            removed = [
+                route for route in self._routes(config) or []
+                if saas_template.route_has_host(route, domain)
+            ]
 
             try:
                 new_config = saas_template.delete_https_domain(
                     domain, config, port=self.https_port
                 )
 
-                # Try loading new config. If not successful, load the previous config
-                if self.load_new_config(new_config):
-                    return True
+                # Routes created with an @id can be removed on their own
+                if len(removed) == 1 and removed[0].get("@id"):
+                    return self.apply_route_change(
+                        "DELETE", f"/id/{removed[0]['@id']}", new_config
+                    )
 
-                self.load_new_config(config)
-                return False
+                # Try loading new config. If not successful, restore the previous config
+                return self.load_or_rollback(new_config)
 
             except DomainDoesNotExist:
-                self.logger.error(f"Domain '{domain} does not exist.")
+                self.logger.error("Domain '%s does not exist.", domain)
                 raise HTTPException(
                     status_code=HTTPStatus.NOT_FOUND,
                     detail=f"Domain '{domain}' does not exist.",
@@ -190,26 +276,35 @@ class CaddyAPIConfigurator:
 
         except requests.exceptions.HTTPError as e:
             self.logger.error(
-                f"An error occurred while deleting the domain '{domain}': {e}"
+                "An error occurred while deleting the domain '%s': %s", domain, e
             )
             # self.logger.error(f"Response content: {response.content.decode('utf-8')}")
             raise
 
+    def _routes(self, config):
+        try:
+            return config["apps"]["http"]["servers"][f"{self.https_port}"]["routes"]
+        except KeyError:
+            return None
+
     def list_domains(self):
         try:
             # Fetch the entire Caddy configuration
-            response = requests.get(f"{self.api_url}/config/")
+            response = self._session.get(f"{self.api_url}/config/")
             response.raise_for_status()
-            config = response.json()
+            config = orjson.loads(response.content)
 
             # Add domain to match
             domains = saas_template.list_domains(config, port=self.https_port)
             return domains
         except requests.exceptions.HTTPError as e:
-            self.logger.error(f"An error occurred while listing domains: {e}")
-            self.logger.error(f"Response content: {response.content.decode('utf-8')}")
+            self.logger.error("An error occurred while listing domains: %s", e)
+            self.logger.error("Response content: %s", response.content.decode('utf-8'))
             return
 
+    def close(self):
+        self._session.close()
+
 
 if __name__ == "__main__":
     CADDY_API_URL = "http://localhost:2019"
@@ -234,8 +329,9 @@ if __name__ == "__main__":
         "customer5.domain.localhost",
     ]
 
-    for custom_domain in custom_domains:
-        configurator.add_domain(custom_domain, SAAS_UPSTREAM)
+    configurator.add_domains(
+        [(custom_domain, SAAS_UPSTREAM) for custom_domain in custom_domains]
+    )
 
     # We want to save the config so the changes persist during restart
     configurator.save_config(CADDY_FILE)
@@ -57,7 +57,7 @@ def add_https_domain(domain, upstream, port=HTTPS_PORT, template=None, replace=T
         servers[f"{port}"] = https_server
 
     routes: List[Dict] = https_server.get("routes", [])
-    expected_route = route_template(domain, upstream, disable_https=disable_https)
+    expected_route = route_template(domain, upstream, disable_https=disable_https, route_id=domain_route_id(domain))
     exists = False
     for route in routes:
         for match in route.get("match", []):
@@ -75,8 +75,12 @@ def add_https_domain(domain, upstream, port=HTTPS_PORT, template=None, replace=T
     return template
 
 
-def route_template(domain, upstream, disable_https=False):
-    return {
+def domain_route_id(domain):
+    return f"route-{domain}"
+
+
+def route_template(domain, upstream, disable_https=False, route_id=None):
+    route = {
         "handle": [
             {
                 "handler": "subroute",
@@ -97,6 +101,11 @@ def route_template(domain, upstream, disable_https=False):
         "terminal": True
     }
 
+    if route_id:
+        route["@id"] = route_id
+
+    return route
+
 
 def reverse_proxy_handle_template(upstream, disable_https=False, handle_id=None):
     if ":" not in upstream:
@@ -139,22 +148,20 @@ def reverse_proxy_handle_template(upstream, disable_https=False, handle_id=None)
     return handle
 
 
+def route_has_host(route, domain):
+    return any(domain in match.get("host", []) for match in route.get("match", []))
+
+
 def delete_https_domain(domain, template, port=HTTPS_PORT):
     try:
         template = template.copy()
         routes = template["apps"]["http"]["servers"][f"{port}"]["routes"]
 
-        removed = False
-        for route in routes.copy():
-            for match in route.get("match", []):
-                if domain in match.get("host", []):
-                    routes.remove(route)
-                    removed = True
-
-        if not removed:
+        kept = [route for route in routes if not route_has_host(route, domain)]
+        if len(kept) == len(routes):
             raise DomainDoesNotExist(f"{domain} does not exist")
 
-        template["apps"]["http"]["servers"][f"{port}"]["routes"] = routes
+        template["apps"]["http"]["servers"][f"{port}"]["routes"] = kept
         return template
 
     except KeyError:
@@ -1,6 +1,8 @@
+import asyncio
 import logging
 import os
 
+import httpx
 from dotenv import load_dotenv
 from fastapi import FastAPI, Depends
 from fastapi.openapi.docs import get_swagger_ui_html
@@ -11,7 +13,9 @@ from starlette.middleware.trustedhost import TrustedHostMiddleware
 from starlette.responses import RedirectResponse, JSONResponse
 
 from app.api import domain_api
+from app.caddy.caddy import caddy_server
 from app.security import API_KEY_NAME, COOKIE_DOMAIN, get_api_key
+from app.tokens import token_store
 
 # Load all environment variables from .env uploaded_file
 load_dotenv()
@@ -71,9 +75,24 @@ async def get_documentation(api_key: APIKey = Depends(get_api_key)):
 
 @app.on_event("startup")
 async def startup():
-    logger.info("App started")
+    # Shared client so challenge probes reuse connections between requests
+    app.state.http_client = httpx.AsyncClient(
+        timeout=5.0, limits=httpx.Limits(max_keepalive_connections=100)
+    )
+    app.state.config_saver = asyncio.create_task(caddy_server.save_config_in_background())
+    logger.info("App started on %s event loop", type(asyncio.get_running_loop()).__module__)
 
 
 @app.on_event("shutdown")
 async def shutdown():
     logger.info("App is shutting down")
+    await app.state.http_client.aclose()
+    app.state.config_saver.cancel()
+    try:
+        if not caddy_server.save_config():
+            logger.error("Pending configuration changes could not be saved")
+    except Exception as e:
+        logger.error("An error occurred while saving the configuration: %s", e)
+    finally:
+        caddy_server.close()
+        token_store.close()
@@ -0,0 +1,79 @@
+import logging
+import os
+import sqlite3
+import threading
+import time
+
+from app.utils import normalize_domain, silent_remove_file
+
+DEFAULT_TOKEN_DB_FILE = "domains/tokens.db"
+LEGACY_TEXTS_DIR = "domains/texts/"
+
+
+class TokenStore:
+
+    def __init__(self):
+        self.logger = logging.getLogger(__name__)
+        self.db_file = os.environ.get('TOKEN_DB_FILE', DEFAULT_TOKEN_DB_FILE)
+        directory = os.path.dirname(self.db_file)
+        if directory and not os.path.exists(directory):
+            os.makedirs(directory)
+
+        # One connection is shared by all requests, calls are serialized with a lock
+        self._lock = threading.Lock()
+        # All tokens are kept in memory, the table is only the backing store
+        self._tokens = {}
+        self._conn = sqlite3.connect(self.db_file, check_same_thread=False, isolation_level=None)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS tokens ("
+            "domain TEXT PRIMARY KEY, token TEXT NOT NULL, created_at REAL NOT NULL)"
+        )
+        self.import_text_files(LEGACY_TEXTS_DIR)
+        self._tokens = dict(self._conn.execute("SELECT domain, token FROM tokens"))
+
+    def import_text_files(self, texts_dir):
+        # Tokens used to be stored as domains/texts/<domain>.txt
+        if not os.path.isdir(texts_dir):
+            return
+        with os.scandir(texts_dir) as entries:
+            for entry in entries:
+                if not entry.is_file() or not entry.name.endswith(".txt"):
+                    continue
+                with open(entry.path, "r") as file:
+                    token = file.read()
+                self.get_or_create(entry.name[:-len(".txt")], token)
+                silent_remove_file(entry.path)
+                self.logger.info("Imported token file %s", entry.path)
+
+    def get(self, domain):
+        return self._tokens.get(normalize_domain(domain))
+
+    def get_or_create(self, domain, token):
+        domain = normalize_domain(domain)
+        cached = self._tokens.get(domain)
+        if cached is not None:
+            return cached
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR IGNORE INTO tokens (domain, token, created_at) VALUES (?, ?, ?)",
+                (domain, token, time.time()),
+            )
+            row = self._conn.execute(
+                "SELECT token FROM tokens WHERE domain = ?", (domain,)
+            ).fetchone()
+            self._tokens[domain] = row[0]
+        return row[0]
+
+    def delete(self, domain):
+        domain = normalize_domain(domain)
+        with self._lock:
+            self._conn.execute("DELETE FROM tokens WHERE domain = ?", (domain,))
+            self._tokens.pop(domain, None)
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+
+token_store = TokenStore()
@@ -1,14 +1,89 @@
 import os, errno
-import string
-import random
+import logging
+import re
+import secrets
+import time
+from collections import OrderedDict
+from functools import lru_cache
 
-def generate_random_string(length=32):
-    letters = string.ascii_letters + string.digits
-    return "bettercollected_" + ''.join(random.choice(letters) for i in range(length))
+import dns.asyncresolver
+import dns.resolver
+import validators
+from dotenv import load_dotenv
+
+load_dotenv()
+logger = logging.getLogger(__name__)
+
+DNS_NAMESERVERS = ['1.1.1.1', '1.0.0.1']
+
+# Cached answers are kept for the record's own TTL, capped so that a record a
+# user has just added shows up on the next verify attempt.
+DNS_CACHE_MAX_TTL = int(os.environ.get('DNS_CACHE_TTL', 30))
+DNS_CACHE_MAX_SIZE = 4096
+
+_dns_cache = OrderedDict()
+
+# Plain ASCII domains, anything else is left to validators.domain
+_FAST_DOMAIN = re.compile(r"(?:[a-z0-9](?:[a-z0-9-]{0,61}[a-z0-9])?\.){1,126}[a-z]{2,63}", re.ASCII | re.IGNORECASE)
+
+_resolver = dns.asyncresolver.Resolver(configure=False)
+_resolver.nameservers = DNS_NAMESERVERS
+
+
+def generate_random_string(length=32, *, prefix="bettercollected_"):
+    # token_urlsafe encodes 3 bytes as 4 characters
+    return prefix + secrets.token_urlsafe((length * 3 + 3) // 4)[:length]
 
 def silent_remove_file(filename):
     try:
         os.remove(filename)
-    except OSError as e: 
-        if e.errno != errno.ENOENT: 
-            raise 
\ No newline at end of file
+    except OSError as e:
+        if e.errno != errno.ENOENT:
+            raise
+
+def is_valid_domain(domain):
+    if _FAST_DOMAIN.fullmatch(domain):
+        return True
+    return bool(validators.domain(domain))
+
+@lru_cache(maxsize=4096)
+def normalize_domain(domain):
+    return domain.strip().rstrip(".").lower()
+
+async def _resolve(domain, rrtype):
+    key = (normalize_domain(domain), rrtype)
+    now = time.monotonic()
+    cached = _dns_cache.get(key)
+    if cached and cached[0] > now:
+        _dns_cache.move_to_end(key)
+        return cached[1]
+
+    ttl = DNS_CACHE_MAX_TTL
+    try:
+        answer = await _resolver.resolve(domain, rrtype)
+        if rrtype == 'TXT':
+            values = [txt_string.decode() for rdata in answer for txt_string in rdata.strings]
+        else:
+            values = [rdata.to_text() for rdata in answer]
+        if answer.rrset is not None:
+            ttl = min(answer.rrset.ttl, DNS_CACHE_MAX_TTL)
+    except dns.resolver.NoAnswer:
+        logger.info("No %s record found for %s", rrtype, domain)
+        values = []
+    except dns.resolver.NXDOMAIN:
+        logger.info("The domain %s does not exist", domain)
+        values = []
+
+    _dns_cache[key] = (now + ttl, values)
+    _dns_cache.move_to_end(key)
+    while len(_dns_cache) > DNS_CACHE_MAX_SIZE:
+        _dns_cache.popitem(last=False)
+    return values
+
+async def resolve_txt(domain):
+    return await _resolve(domain, 'TXT')
+
+def invalidate_dns(domain):
+    domain = normalize_domain(domain)
+    for key in [key for key in _dns_cache if key[0] == domain]:
+        del _dns_cache[key]
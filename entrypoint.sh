@@ -1,4 +1,4 @@
 #!/bin/bash
 
 /usr/bin/caddy start
-/usr/local/bin/uvicorn app.main:app --host 0.0.0.0 --port 9000
\ No newline at end of file
+/usr/local/bin/uvicorn app.main:app --host 0.0.0.0 --port 9000 --loop uvloop --http httptools
\ No newline at end of file
@@ -1,4 +1,4 @@
 import uvicorn
 
 if __name__ == "__main__":
-    uvicorn.run("app.main:app", host="0.0.0.0", port=9000, log_level="info", reload=True)
+    uvicorn.run("app.main:app", host="0.0.0.0", port=9000, log_level="info", reload=True, loop="uvloop", http="httptools")